@@ -1,11 +1,21 @@
 from flask import Flask, request, jsonify, send_from_directory
 import os
 import json
+import gzip
+import tempfile
+import time
 import secrets
 import hashlib
 from datetime import datetime, timedelta
 import logging
 import asyncio
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,20 +23,77 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 bot_application = None
 
+# Each worker process owns one event loop thread that the bot lives on
+_bot_loop = None
+_bot_loop_pid = None
+_bot_pid = None
+_loop_lock = threading.Lock()
+_bot_lock = threading.Lock()
+
+_bot_failed_at = 0
+_bot_retry_delay = 0
+
+# Token the current bot was built with; a different configured token triggers a swap
+_bot_token = None
+_token_cache = (None, '')
+_swap_lock = threading.Lock()
+_swap_pending_lock = threading.Lock()
+_swap_pending = False
+_swap_failed_token = None
+
+# Seconds a replaced bot keeps its connections open for in-flight updates
+BOT_RETIRE_GRACE = 5
+
+# Backoff between attempts to start a bot that failed to build or initialize
+BOT_RETRY_MIN = 2
+BOT_RETRY_MAX = 60
+
 # Admin notification channel
 ADMIN_CHANNEL_ID = "-1003449753466"
 
-DATA_FILE = 'data.json'
+DATA_FILE = os.environ.get('DATA_FILE', 'data.json')
+
+# Snapshots: a delta every BACKUP_INTERVAL seconds, a full snapshot every
+# BACKUP_FULL_EVERY snapshots (daily by default), BACKUP_KEEP_FULL chains kept
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', 3600))
+BACKUP_FULL_EVERY = int(os.environ.get('BACKUP_FULL_EVERY', 24))
+BACKUP_KEEP_FULL = int(os.environ.get('BACKUP_KEEP_FULL', 7))
+
+# Key compaction: unreferenced, expired and revoked keys are moved out of
+# data.json into a gzipped JSON-lines archive every COMPACT_INTERVAL seconds
+ARCHIVE_FILE = os.environ.get('ARCHIVE_FILE', 'archive.jsonl.gz')
+COMPACT_INTERVAL = int(os.environ.get('COMPACT_INTERVAL', 6 * 3600))
+COMPACT_GRACE_DAYS = int(os.environ.get('COMPACT_GRACE_DAYS', 7))
+
+# Append-only commission ledger; running balances stay on each reseller in data.json
+COMMISSIONS_FILE = os.environ.get('COMMISSIONS_FILE', 'commissions.jsonl')
+
+# Override for the Telegram Bot API endpoint (used by the local benchmark stub)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '')
 
 def load_data():
     if os.path.exists(DATA_FILE):
         with open(DATA_FILE, 'r') as f:
-            return json.load(f)
+            data = json.load(f)
+        data.setdefault('activities', [])
+        data.setdefault('referrals', {})
+        data.setdefault('referral_sales', {})
+        if 'referral_index' not in data:
+            data['referral_index'] = {
+                r['referral_code']: uid
+                for uid, r in data.get('resellers', {}).items()
+                if r.get('referral_code')
+            }
+        return data
     return {
         'users': {},
         'resellers': {},
         'apis': {},
         'activities': [],
+        'referrals': {},
+        'referral_index': {},
+        'referral_sales': {},
         'settings': {
             'master_api': '',
             'bot_token': '',
@@ -41,23 +108,458 @@ def load_data():
         }
     }
 
+# Read the process umask once at import so atomic writes get normal file permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def write_atomic(path, content):
+    """Write bytes to a temp file and rename it over path so readers never see a partial file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates 0600 files; keep the existing mode or follow the umask
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def cleanup_temp_files(directory, max_age=3600):
+    """Remove temp files left behind by writes interrupted by a crash"""
+    if not os.path.isdir(directory):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.startswith('.tmp-') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+class _StoreLock:
+    """Re-entrant lock shared by every writer of DATA_FILE, across threads and worker processes"""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file_lock = None
+    
+    def __enter__(self):
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            self._file_lock = _FileLock(f"{DATA_FILE}.lock")
+            self._file_lock.__enter__()
+        return self
+    
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            self._file_lock.__exit__(*exc)
+        self._lock.release()
+
+store_lock = _StoreLock()
+
 def save_data(data):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+    with store_lock:
+        write_atomic(DATA_FILE, json.dumps(data, indent=2).encode())
+
+def update_data(fn):
+    """Load, modify and save the store under store_lock so no writer saves a stale copy"""
+    with store_lock:
+        data = load_data()
+        result = fn(data)
+        save_data(data)
+        return result
 
 def generate_api_key():
     return f"pplx-{secrets.token_urlsafe(32)}"
 
+def active_api_key(data, user_id):
+    """Return the user's current key if it is still active and unexpired"""
+    user = data['users'].get(str(user_id))
+    api = data['apis'].get(user.get('api_key')) if user else None
+    if api and api.get('status') == 'active' and datetime.fromisoformat(api['expiry']) > datetime.now():
+        return user['api_key']
+    return None
+
+def attribute_referral(data, user_id, code):
+    """Link a new user to the reseller owning a referral code (first code wins)"""
+    user_id = str(user_id)
+    # Existing customers are never re-attributed, so resellers can't claim their renewals
+    if user_id in data['users'] or any(api.get('user_id') == user_id for api in data['apis'].values()):
+        return None
+    reseller_id = data['referral_index'].get(code.strip().upper())
+    if not reseller_id or reseller_id == user_id or user_id in data['referrals']:
+        return None
+    data['referrals'][user_id] = reseller_id
+    return reseller_id
+
+def append_ledger(entry):
+    """Append an entry to the commission ledger; call under store_lock before save_data"""
+    with open(COMMISSIONS_FILE, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def read_ledger():
+    if not os.path.exists(COMMISSIONS_FILE):
+        return []
+    with open(COMMISSIONS_FILE, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def record_commission(data, user_id, api_key):
+    """Credit the referring reseller for a referred user's first key sale and update balances"""
+    user_id = str(user_id)
+    reseller_id = data['referrals'].get(user_id)
+    reseller = data['resellers'].get(reseller_id) if reseller_id else None
+    if reseller is None or reseller.get('status') != 'active':
+        return None
+    # Only the first sale earns: renewals and re-issues after revoke/expiry don't
+    if user_id in data['referral_sales']:
+        return None
+    
+    amount = int(data['settings']['api_price'] * reseller['commission'] / 100)
+    entry = {
+        'time': datetime.now().isoformat(),
+        'type': 'credit',
+        'reseller_id': reseller_id,
+        'user_id': user_id,
+        'api_key': api_key,
+        'amount': amount
+    }
+    append_ledger(entry)
+    data['referral_sales'][user_id] = entry['time']
+    
+    reseller['sales'] = reseller.get('sales', 0) + 1
+    reseller['earnings'] = reseller.get('earnings', 0) + amount
+    reseller['pending'] = reseller.get('pending', 0) + amount
+    return entry
+
+def record_withdrawal(data, reseller_id, amount):
+    """Append a debit to the ledger moving funds from pending to withdrawn"""
+    reseller = data['resellers'][reseller_id]
+    if amount <= 0 or amount > reseller.get('pending', 0):
+        raise ValueError('Invalid withdrawal amount')
+    
+    entry = {
+        'time': datetime.now().isoformat(),
+        'type': 'debit',
+        'reseller_id': reseller_id,
+        'amount': amount
+    }
+    append_ledger(entry)
+    
+    reseller['pending'] = reseller.get('pending', 0) - amount
+    reseller['withdrawn'] = reseller.get('withdrawn', 0) + amount
+    return entry
+
 def log_activity(user, action, status='success'):
     try:
-        data = load_data()
         activity = {'time': datetime.now().isoformat(), 'user': user, 'action': action, 'status': status}
-        data['activities'].insert(0, activity)
-        data['activities'] = data['activities'][:100]
-        save_data(data)
+        
+        def add(data):
+            data['activities'].insert(0, activity)
+            data['activities'] = data['activities'][:100]
+        
+        update_data(add)
     except Exception as e:
         logger.error(f"Error logging: {e}")
 
+# Snapshots & backups
+_snapshot_lock = threading.Lock()
+_snapshot_base = None  # (snapshot id, state) the next delta is diffed against
+_backup_thread_pid = None
+_MISSING = object()
+
+def _backup_path(name):
+    return os.path.join(BACKUP_DIR, name)
+
+def load_manifest():
+    path = _backup_path('manifest.json')
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {'snapshots': []}
+
+def _save_manifest(manifest):
+    write_atomic(_backup_path('manifest.json'), json.dumps(manifest, indent=2).encode())
+
+class _FileLock:
+    """Serialize a background job across worker processes"""
+    def __init__(self, path):
+        self.path = path
+    
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.f = open(self.path, 'w')
+        if fcntl:
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+def read_snapshot_state():
+    """Point-in-time copy of the store; save_data swaps the file atomically so no lock is needed"""
+    try:
+        with open(DATA_FILE, 'rb') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+def diff_state(old, new):
+    """Per-record delta between two store states"""
+    delta = {}
+    for section in set(old) | set(new):
+        before, after = old.get(section, _MISSING), new.get(section, _MISSING)
+        if before == after:
+            continue
+        if after is _MISSING:
+            delta[section] = {'drop': True}
+        elif isinstance(before, dict) and isinstance(after, dict):
+            delta[section] = {
+                'set': {k: v for k, v in after.items() if before.get(k, _MISSING) != v},
+                'del': [k for k in before if k not in after]
+            }
+        elif isinstance(before, list) and isinstance(after, list) and after[:len(before)] == before:
+            delta[section] = {'append': after[len(before):]}
+        elif isinstance(before, list) and isinstance(after, list) and _prepended(before, after) < len(after):
+            # Newest-first lists such as activities: new head, old entries shifted and truncated
+            added = _prepended(before, after)
+            delta[section] = {'prepend': after[:added], 'length': len(after)}
+        else:
+            delta[section] = {'replace': after}
+    return delta
+
+def _prepended(before, after):
+    """Number of entries pushed onto the front of before to produce after"""
+    for added in range(len(after) + 1):
+        if after[added:] == before[:len(after) - added]:
+            return added
+    return len(after)
+
+def apply_delta(state, delta):
+    for section, change in delta.items():
+        if change.get('drop'):
+            state.pop(section, None)
+        elif 'replace' in change:
+            state[section] = change['replace']
+        elif 'prepend' in change:
+            state[section] = (change['prepend'] + state.get(section, []))[:change['length']]
+        elif 'append' in change:
+            state.setdefault(section, []).extend(change['append'])
+        else:
+            records = state.setdefault(section, {})
+            records.update(change.get('set', {}))
+            for key in change.get('del', []):
+                records.pop(key, None)
+    return state
+
+def _read_snapshot_file(name):
+    with gzip.open(_backup_path(name), 'rb') as f:
+        return json.loads(f.read())
+
+def restore_state(snapshot_id=None, manifest=None):
+    """Rebuild the store as of a snapshot: its full base plus the deltas after it"""
+    snapshots = (manifest or load_manifest())['snapshots']
+    if not snapshots:
+        return None
+    
+    ids = [snap['id'] for snap in snapshots]
+    end = ids.index(snapshot_id) if snapshot_id else len(ids) - 1
+    start = end
+    while snapshots[start]['type'] != 'full':
+        start -= 1
+    
+    state = _read_snapshot_file(snapshots[start]['file'])
+    for snap in snapshots[start + 1:end + 1]:
+        apply_delta(state, _read_snapshot_file(snap['file']))
+    return state
+
+def _prune_snapshots(manifest):
+    full_indexes = [i for i, snap in enumerate(manifest['snapshots']) if snap['type'] == 'full']
+    if len(full_indexes) <= BACKUP_KEEP_FULL:
+        return
+    cutoff = full_indexes[-BACKUP_KEEP_FULL]
+    for snap in manifest['snapshots'][:cutoff]:
+        try:
+            os.remove(_backup_path(snap['file']))
+        except FileNotFoundError:
+            pass
+    manifest['snapshots'] = manifest['snapshots'][cutoff:]
+
+def take_snapshot(full=False):
+    """Write a compressed full snapshot or a delta against the previous one"""
+    global _snapshot_base
+    with _snapshot_lock, _FileLock(_backup_path('.lock')):
+        state = read_snapshot_state()
+        if state is None:
+            return None
+        
+        manifest = load_manifest()
+        snapshots = manifest['snapshots']
+        base = None
+        if snapshots:
+            last_id = snapshots[-1]['id']
+            if _snapshot_base and _snapshot_base[0] == last_id:
+                base = _snapshot_base[1]
+            else:
+                base = restore_state(last_id, manifest)
+        
+        deltas_since_full = 0
+        for snap in reversed(snapshots):
+            if snap['type'] == 'full':
+                break
+            deltas_since_full += 1
+        
+        if full or base is None or deltas_since_full + 1 >= BACKUP_FULL_EVERY:
+            kind, payload = 'full', state
+        else:
+            kind, payload = 'delta', diff_state(base, state)
+            if not payload:
+                _snapshot_base = (snapshots[-1]['id'], state)
+                return snapshots[-1]
+        
+        now = datetime.now()
+        snapshot_id = now.strftime('%Y%m%dT%H%M%S%f')
+        filename = f"{kind}-{snapshot_id}.json.gz"
+        content = gzip.compress(json.dumps(payload, separators=(',', ':')).encode())
+        write_atomic(_backup_path(filename), content)
+        
+        entry = {'id': snapshot_id, 'type': kind, 'file': filename, 'time': now.isoformat(), 'size': len(content)}
+        snapshots.append(entry)
+        if kind == 'full':
+            _prune_snapshots(manifest)
+        _save_manifest(manifest)
+        
+        _snapshot_base = (snapshot_id, state)
+        logger.info(f"Snapshot {snapshot_id} ({kind}, {len(content)} bytes)")
+        return entry
+
+def restore_snapshot(snapshot_id=None):
+    """Replace the live store with a snapshot, keeping a full snapshot of the current data first"""
+    # Hold the store lock so no write lands between the safety snapshot and the restore
+    with store_lock:
+        state = restore_state(snapshot_id)
+        if state is None:
+            return None
+        take_snapshot(full=True)
+        save_data(state)
+        return state
+
+def _backup_loop():
+    while True:
+        time.sleep(BACKUP_INTERVAL)
+        try:
+            snapshots = load_manifest()['snapshots']
+            if snapshots:
+                age = (datetime.now() - datetime.fromisoformat(snapshots[-1]['time'])).total_seconds()
+                if age < BACKUP_INTERVAL * 0.9:
+                    continue
+            take_snapshot()
+        except Exception as e:
+            logger.error(f"Backup error: {e}")
+
+def start_backups():
+    """Start the periodic snapshot thread for this worker process"""
+    global _backup_thread_pid
+    cleanup_temp_files(os.path.dirname(os.path.abspath(DATA_FILE)))
+    cleanup_temp_files(BACKUP_DIR)
+    if BACKUP_INTERVAL <= 0 or _backup_thread_pid == os.getpid():
+        return
+    _backup_thread_pid = os.getpid()
+    threading.Thread(target=_backup_loop, name='backups', daemon=True).start()
+
+# Key compaction
+_compact_thread_pid = None
+
+def find_compactable_keys(data):
+    """Map each cold key to why it can leave the hot store"""
+    now = datetime.now()
+    cutoff = now - timedelta(days=COMPACT_GRACE_DAYS)
+    referenced = {user.get('api_key') for user in data['users'].values()}
+    
+    reasons = {}
+    for api_key, api in data['apis'].items():
+        # Every key was handed to someone, so each reason gets the same grace period
+        if api.get('status') == 'revoked':
+            if datetime.fromisoformat(api.get('revoked_at', api['created'])) < cutoff:
+                reasons[api_key] = 'revoked'
+        elif datetime.fromisoformat(api['expiry']) < cutoff:
+            reasons[api_key] = 'expired'
+        elif api_key not in referenced and datetime.fromisoformat(api['created']) < cutoff:
+            reasons[api_key] = 'unreferenced'
+    return reasons
+
+def compact_keys():
+    """Archive cold keys into ARCHIVE_FILE and drop them from data.json"""
+    # Hold the store lock from load to save so no concurrent save_data lands in
+    # between and gets overwritten by this copy
+    with store_lock:
+        data = load_data()
+        reasons = find_compactable_keys(data)
+        
+        stats = data.get('compaction', {'runs': 0, 'archived': {}, 'total_archived': 0})
+        counts = {}
+        if reasons:
+            archived = datetime.now().isoformat()
+            # Archive first: a crash before save_data leaves duplicates, never lost keys
+            with gzip.open(ARCHIVE_FILE, 'at') as f:
+                for api_key, reason in reasons.items():
+                    f.write(json.dumps({'key': api_key, 'reason': reason, 'archived': archived, 'api': data['apis'][api_key]}) + '\n')
+            
+            for api_key, reason in reasons.items():
+                api = data['apis'].pop(api_key)
+                counts[reason] = counts.get(reason, 0) + 1
+                user = data['users'].get(api.get('user_id'))
+                if user and user.get('api_key') == api_key:
+                    user['status'] = reason
+                    user['api_key'] = None
+        
+        stats['runs'] += 1
+        stats['last_run'] = datetime.now().isoformat()
+        stats['last_archived'] = counts
+        for reason, count in counts.items():
+            stats['archived'][reason] = stats['archived'].get(reason, 0) + count
+        stats['total_archived'] += len(reasons)
+        stats['hot_keys'] = len(data['apis'])
+        data['compaction'] = stats
+        save_data(data)
+    
+    if reasons:
+        logger.info(f"Compacted {len(reasons)} keys: {counts}")
+        log_activity('System', f'Archived {len(reasons)} API keys')
+    return stats
+
+def _compact_loop():
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        try:
+            last_run = load_data().get('compaction', {}).get('last_run')
+            if last_run and (datetime.now() - datetime.fromisoformat(last_run)).total_seconds() < COMPACT_INTERVAL * 0.9:
+                continue
+            compact_keys()
+        except Exception as e:
+            logger.error(f"Compaction error: {e}")
+
+def start_compactor():
+    """Start the periodic key compaction thread for this worker process"""
+    global _compact_thread_pid
+    if COMPACT_INTERVAL <= 0 or _compact_thread_pid == os.getpid():
+        return
+    _compact_thread_pid = os.getpid()
+    threading.Thread(target=_compact_loop, name='compactor', daemon=True).start()
+
 async def send_admin_notification(message):
     """Send notification to admin channel only"""
     try:
@@ -99,20 +601,53 @@ async def check_channel_subscription(user_id):
         logger.error(f"Check subscription error: {e}")
         return True
 
-def setup_bot():
-    global bot_application
+def _run_bot_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+def get_bot_loop():
+    """Return this process's bot event loop, starting it after boot or fork"""
+    global _bot_loop, _bot_loop_pid
+    with _loop_lock:
+        if _bot_loop is None or _bot_loop_pid != os.getpid():
+            _bot_loop = asyncio.new_event_loop()
+            _bot_loop_pid = os.getpid()
+            threading.Thread(target=_run_bot_loop, args=(_bot_loop,), name='bot-loop', daemon=True).start()
+        return _bot_loop
+
+def run_async(coro, timeout=60):
+    """Run a coroutine on the bot loop from a Flask thread and wait for it"""
+    return asyncio.run_coroutine_threadsafe(coro, get_bot_loop()).result(timeout)
+
+def configured_bot_token():
+    """BOT_TOKEN from the environment, else the stored setting (cached until data.json changes)"""
+    global _token_cache
+    if 'BOT_TOKEN' in os.environ:
+        return os.environ['BOT_TOKEN']
     try:
-        from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-        from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-        
-        data = load_data()
-        bot_token = os.environ.get('BOT_TOKEN', data['settings'].get('bot_token', ''))
+        stat = os.stat(DATA_FILE)
+        # save_data replaces the file, so the inode changes even within one mtime tick
+        mtime = (stat.st_ino, stat.st_mtime_ns)
+    except FileNotFoundError:
+        mtime = None
+    if mtime is None or _token_cache[0] != mtime:
+        _token_cache = (mtime, load_data()['settings'].get('bot_token', ''))
+    return _token_cache[1]
+
+def setup_bot(bot_token=None):
+    """Build a new, uninitialized bot Application from the given or configured token"""
+    try:
+        if bot_token is None:
+            bot_token = configured_bot_token()
         
         if not bot_token:
             logger.warning("Bot token not configured")
             return None
         
-        bot_application = Application.builder().token(bot_token).build()
+        builder = Application.builder().token(bot_token)
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+        application = builder.build()
         
         async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id = update.effective_user.id
@@ -121,6 +656,16 @@ def setup_bot():
             
             data = load_data()
             
+            # Deep-link attribution: /start <referral_code>
+            if context.args:
+                with store_lock:
+                    data = load_data()
+                    reseller_id = attribute_referral(data, user_id, context.args[0])
+                    if reseller_id:
+                        save_data(data)
+                if reseller_id:
+                    log_activity(username, f"Referred by {data['resellers'][reseller_id]['id']}")
+            
             # Send admin notification for new user
             notification = f"""
 👤 <b>New User Started Bot</b>
@@ -232,33 +777,43 @@ Choose an option:
                 return
             
             if query.data == 'get_api':
-                api_key = generate_api_key()
-                expiry = (datetime.now() + timedelta(days=30)).isoformat()
-                
-                data['apis'][api_key] = {
-                    'user_id': str(user_id),
-                    'username': username,
-                    'type': 'perplexity',
-                    'requests': 0,
-                    'limit': 1000,
-                    'status': 'active',
-                    'created': datetime.now().isoformat(),
-                    'expiry': expiry
-                }
-                
-                data['users'][str(user_id)] = {
-                    'name': username,
-                    'api_key': api_key,
-                    'status': 'active',
-                    'expiry': expiry,
-                    'telegram_id': str(user_id)
-                }
+                # Re-tapping returns the user's active key instead of minting another
+                with store_lock:
+                    data = load_data()
+                    api_key = active_api_key(data, user_id)
+                    is_new = api_key is None
+                    
+                    if is_new:
+                        api_key = generate_api_key()
+                        expiry = (datetime.now() + timedelta(days=30)).isoformat()
+                        
+                        data['apis'][api_key] = {
+                            'user_id': str(user_id),
+                            'username': username,
+                            'type': 'perplexity',
+                            'requests': 0,
+                            'limit': 1000,
+                            'status': 'active',
+                            'created': datetime.now().isoformat(),
+                            'expiry': expiry
+                        }
+                        
+                        data['users'][str(user_id)] = {
+                            'name': username,
+                            'api_key': api_key,
+                            'status': 'active',
+                            'expiry': expiry,
+                            'telegram_id': str(user_id)
+                        }
+                        
+                        record_commission(data, user_id, api_key)
+                        save_data(data)
                 
-                save_data(data)
-                log_activity(username, 'API Key Generated')
+                if is_new:
+                    log_activity(username, 'API Key Generated')
                 
-                # Send admin notification
-                admin_notif = f"""
+                    # Send admin notification
+                    admin_notif = f"""
 🎉 <b>New API Key Generated!</b>
 
 <b>User Info:</b>
@@ -279,18 +834,22 @@ Choose an option:
 • Total APIs: {len(data['apis'])}
 • Revenue: ₹{len(data['users']) * 499}
 """
-                asyncio.create_task(send_admin_notification(admin_notif))
+                    asyncio.create_task(send_admin_notification(admin_notif))
+                
+                api = data['apis'][api_key]
+                expiry = api['expiry']
+                title = "✅ <b>API Key Generated!</b>" if is_new else "🔑 <b>Your Active API Key</b>"
                 
                 await query.edit_message_text(
                     f"""
-✅ <b>API Key Generated!</b>
+{title}
 
 🔑 <b>Your Key:</b>
 <code>{api_key}</code>
 
 📊 <b>Details:</b>
 • Type: Perplexity AI
-• Limit: 1,000 requests/mo
+• Limit: {api['limit']:,} requests/mo
 • Expiry: {datetime.fromisoformat(expiry).strftime('%d %b %Y')}
 • Status: Active ✅
 
@@ -302,9 +861,15 @@ Use /start to return.
                 )
             
             elif query.data == 'dashboard':
-                if str(user_id) in data['users']:
-                    user = data['users'][str(user_id)]
-                    api = data['apis'].get(user['api_key'], {})
+                user = data['users'].get(str(user_id))
+                api = data['apis'].get(user.get('api_key')) if user else None
+                if user and api is None:
+                    # Key was archived by the compactor (expired or revoked)
+                    await query.edit_message_text(
+                        "⚠️ <b>Your API key has expired!</b>\n\nTap 🔑 Get API Key for a new one.",
+                        parse_mode='HTML'
+                    )
+                elif user:
                     usage_percent = (api.get('requests', 0) / api.get('limit', 1)) * 100
                     progress = '█' * int(usage_percent / 10) + '░' * (10 - int(usage_percent / 10))
                     days_left = (datetime.fromisoformat(api.get('expiry', datetime.now().isoformat())) - datetime.now()).days
@@ -338,19 +903,28 @@ Use /start to return.
                     )
             
             elif query.data == 'become_reseller':
-                if str(user_id) not in data['resellers']:
-                    reseller_id = f"RSL{secrets.token_hex(4).upper()}"
-                    data['resellers'][str(user_id)] = {
-                        'id': reseller_id,
-                        'name': username,
-                        'commission': data['settings']['default_commission'],
-                        'sales': 0,
-                        'earnings': 0,
-                        'status': 'active',
-                        'joined': datetime.now().isoformat(),
-                        'referral_code': hashlib.md5(str(user_id).encode()).hexdigest()[:8].upper()
-                    }
-                    save_data(data)
+                with store_lock:
+                    data = load_data()
+                    is_new = str(user_id) not in data['resellers']
+                    if is_new:
+                        reseller_id = f"RSL{secrets.token_hex(4).upper()}"
+                        referral_code = hashlib.md5(str(user_id).encode()).hexdigest()[:8].upper()
+                        data['resellers'][str(user_id)] = {
+                            'id': reseller_id,
+                            'name': username,
+                            'commission': data['settings']['default_commission'],
+                            'sales': 0,
+                            'earnings': 0,
+                            'pending': 0,
+                            'withdrawn': 0,
+                            'status': 'active',
+                            'joined': datetime.now().isoformat(),
+                            'referral_code': referral_code
+                        }
+                        data['referral_index'][referral_code] = str(user_id)
+                        save_data(data)
+                
+                if is_new:
                     log_activity(username, 'Became Reseller')
                     
                     # Send admin notification
@@ -384,10 +958,12 @@ Use /start to return.
 🔗 <b>Referral Code:</b>
 <code>{reseller['referral_code']}</code>
 
+📈 <b>Sales:</b> {reseller.get('sales', 0)}
+
 <b>Share your link!</b>
-https://t.me/YourBot?start={reseller['referral_code']}
+https://t.me/{context.bot.username}?start={reseller['referral_code']}
 
-• Per sale: ₹{int(499 * reseller['commission'] / 100)}
+• Per sale: ₹{int(data['settings']['api_price'] * reseller['commission'] / 100)}
 
 Start earning! 💸
 """,
@@ -395,20 +971,21 @@ Start earning! 💸
                 )
             
             elif query.data == 'wallet':
-                wallet_balance = 0
-                if str(user_id) in data['resellers']:
-                    wallet_balance = data['resellers'][str(user_id)].get('earnings', 0)
+                reseller = data['resellers'].get(str(user_id), {})
+                pending = reseller.get('pending', 0)
+                withdrawn = reseller.get('withdrawn', 0)
+                total = reseller.get('earnings', 0)
                 
                 await query.edit_message_text(
                     f"""
 💰 <b>Your Wallet</b>
 
-💵 <b>Balance:</b> ₹{wallet_balance}
+💵 <b>Balance:</b> ₹{pending}
 
 📊 <b>Transactions:</b>
-• Pending: ₹0
-• Withdrawn: ₹0
-• Total: ₹{wallet_balance}
+• Pending: ₹{pending}
+• Withdrawn: ₹{withdrawn}
+• Total: ₹{total}
 
 🏦 <b>Withdrawal:</b>
 Minimum: ₹500
@@ -440,16 +1017,140 @@ Use /start to return.
                     parse_mode='HTML'
                 )
         
-        bot_application.add_handler(CommandHandler('start', start))
-        bot_application.add_handler(CallbackQueryHandler(button_handler))
+        application.add_handler(CommandHandler('start', start))
+        application.add_handler(CallbackQueryHandler(button_handler))
         
-        logger.info("Bot initialized successfully")
-        return bot_application
+        logger.info("Bot built successfully")
+        return application
         
     except Exception as e:
         logger.error(f"Bot setup error: {e}")
         return None
 
+def _bot_ready():
+    return bot_application is not None and _bot_pid == os.getpid()
+
+def start_bot():
+    """Build and initialize the bot once per worker process"""
+    global bot_application, _bot_pid, _bot_failed_at, _bot_retry_delay, _bot_token
+    requested = time.monotonic()
+    with _bot_lock:
+        if _bot_ready():
+            return bot_application
+        if _bot_failed_at > requested:
+            # Another thread failed while this one waited for the lock
+            return None
+        
+        bot_token = configured_bot_token()
+        application = setup_bot(bot_token)
+        if application is not None:
+            try:
+                run_async(application.initialize())
+            except Exception as e:
+                logger.error(f"Bot initialize error: {e}")
+                application = None
+        
+        if application is None:
+            _bot_failed_at = time.monotonic()
+            _bot_retry_delay = min(max(_bot_retry_delay * 2, BOT_RETRY_MIN), BOT_RETRY_MAX)
+            logger.warning(f"Bot not started, retrying in {_bot_retry_delay}s")
+            return None
+        
+        bot_application = application
+        _bot_pid = os.getpid()
+        _bot_retry_delay = 0
+        _bot_token = bot_token
+        logger.info(f"Bot initialized in worker {_bot_pid}")
+        return application
+
+def get_bot():
+    """Return the bot for this worker, (re)starting it with backoff until it is up"""
+    if _bot_ready():
+        # Settings saved by another worker change the token; follow it in the background
+        bot_token = configured_bot_token()
+        if bot_token and bot_token != _bot_token and bot_token != _swap_failed_token:
+            swap_bot_in_background()
+        return bot_application
+    if time.monotonic() < _bot_failed_at + _bot_retry_delay:
+        return None
+    return start_bot()
+
+def swap_bot(force=False):
+    """Warm up a replacement bot and swap it in, then retire the old one"""
+    global bot_application, _bot_pid, _bot_retry_delay, _bot_token, _swap_pending, _swap_failed_token
+    # Swaps run one at a time and read the token only once they hold the lock,
+    # so the last one to finish always installs the newest token
+    with _swap_lock:
+        with _swap_pending_lock:
+            _swap_pending = False
+        
+        bot_token = configured_bot_token()
+        if not force and bot_token == _bot_token and _bot_ready():
+            return bot_application
+        
+        application = setup_bot(bot_token)
+        if application is None:
+            _swap_failed_token = bot_token
+            return None
+        
+        try:
+            run_async(application.initialize())
+        except Exception as e:
+            logger.error(f"Bot swap error: {e}")
+            _swap_failed_token = bot_token
+            return None
+        
+        with _bot_lock:
+            old_application = bot_application
+            bot_application = application
+            _bot_pid = os.getpid()
+            _bot_retry_delay = 0
+            _bot_token = bot_token
+        _swap_failed_token = None
+    
+    if old_application is not None and old_application is not application:
+        asyncio.run_coroutine_threadsafe(_retire_bot(old_application), get_bot_loop())
+    logger.info("Bot application swapped")
+    return application
+
+def swap_bot_in_background():
+    """Queue a swap unless one is already waiting to run"""
+    global _swap_pending
+    with _swap_pending_lock:
+        if _swap_pending:
+            return
+        _swap_pending = True
+    threading.Thread(target=swap_bot, name='bot-swap', daemon=True).start()
+
+async def _retire_bot(application, grace=None):
+    await asyncio.sleep(BOT_RETIRE_GRACE if grace is None else grace)
+    try:
+        await application.shutdown()
+        logger.info("Old bot application shut down")
+    except Exception as e:
+        logger.error(f"Bot shutdown error: {e}")
+
+def stop_bot():
+    """Shut down this worker's bot and stop its event loop"""
+    global bot_application, _bot_pid, _bot_token, _bot_loop
+    with _bot_lock:
+        application = bot_application
+        bot_application = None
+        _bot_pid = None
+        _bot_token = None
+    
+    if _bot_loop is None or _bot_loop_pid != os.getpid():
+        return
+    if application is not None:
+        try:
+            run_async(_retire_bot(application, grace=0))
+        except Exception as e:
+            logger.error(f"Bot shutdown error: {e}")
+    # Drop the loop so a later start_bot() in this process gets a running one
+    with _loop_lock:
+        loop, _bot_loop = _bot_loop, None
+    loop.call_soon_threadsafe(loop.stop)
+
 # Flask Routes
 @app.route('/')
 def index():
@@ -475,6 +1176,68 @@ def get_resellers():
     data = load_data()
     return jsonify(data['resellers'])
 
+@app.route('/api/leaderboard')
+def get_leaderboard():
+    data = load_data()
+    limit = max(request.args.get('limit', 10, type=int), 0)
+    board = sorted(
+        (
+            {
+                'user_id': uid,
+                'id': r['id'],
+                'name': r['name'],
+                'sales': r.get('sales', 0),
+                'earnings': r.get('earnings', 0),
+                'pending': r.get('pending', 0),
+                'withdrawn': r.get('withdrawn', 0)
+            }
+            for uid, r in data['resellers'].items()
+        ),
+        key=lambda r: r['earnings'],
+        reverse=True
+    )
+    return jsonify(board[:limit])
+
+@app.route('/api/commissions')
+def get_commissions():
+    reseller_id = request.args.get('reseller')
+    entries = read_ledger()
+    if reseller_id:
+        entries = [e for e in entries if e['reseller_id'] == reseller_id]
+    return jsonify(entries[::-1][:100])
+
+@app.route('/api/resellers/<reseller_id>/withdraw', methods=['POST'])
+def withdraw_commission(reseller_id):
+    try:
+        payload = request.get_json(silent=True) or {}
+        
+        with store_lock:
+            data = load_data()
+            
+            if reseller_id not in data['resellers']:
+                return jsonify({'success': False, 'message': 'Not found'}), 404
+            
+            reseller = data['resellers'][reseller_id]
+            
+            try:
+                amount = int(payload.get('amount', reseller.get('pending', 0)))
+                record_withdrawal(data, reseller_id, amount)
+            except (TypeError, ValueError):
+                return jsonify({'success': False, 'message': 'Invalid withdrawal amount'}), 400
+            
+            save_data(data)
+        
+        log_activity('Admin', f"Withdrawal ₹{amount} for {reseller['id']}")
+        
+        return jsonify({
+            'success': True,
+            'pending': reseller['pending'],
+            'withdrawn': reseller['withdrawn'],
+            'total': reseller['earnings']
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @app.route('/api/apis')
 def get_apis():
     data = load_data()
@@ -487,47 +1250,61 @@ def get_activities():
 
 @app.route('/api/settings', methods=['GET', 'POST'])
 def settings():
-    data = load_data()
     if request.method == 'POST':
         settings = request.get_json()
-        data['settings'].update(settings)
-        save_data(data)
         
-        if 'bot_token' in settings:
-            global bot_application
-            bot_application = setup_bot()
+        def apply(data):
+            previous_token = data['settings'].get('bot_token', '')
+            data['settings'].update(settings)
+            return previous_token
+        
+        previous_token = update_data(apply)
+        
+        # The admin panel always sends bot_token; only rebuild when it changed
+        if 'bot_token' in settings and settings['bot_token'] != previous_token:
+            swap_bot_in_background()
         
         return jsonify({'success': True})
-    return jsonify(data['settings'])
+    return jsonify(load_data()['settings'])
 
 @app.route('/api/generate', methods=['POST'])
 def generate_api():
-    data = load_data()
     payload = request.get_json()
     
-    api_key = generate_api_key()
-    expiry = (datetime.now() + timedelta(days=int(payload.get('expiryDays', 30)))).isoformat()
-    
-    data['apis'][api_key] = {
-        'user_id': payload['telegramId'],
-        'username': payload['userName'],
-        'type': payload['apiType'],
-        'requests': 0,
-        'limit': int(payload['rateLimit']),
-        'status': 'active',
-        'created': datetime.now().isoformat(),
-        'expiry': expiry
-    }
-    
-    data['users'][payload['telegramId']] = {
-        'name': payload['userName'],
-        'api_key': api_key,
-        'status': 'active',
-        'expiry': expiry,
-        'telegram_id': payload['telegramId']
-    }
+    with store_lock:
+        data = load_data()
+        
+        api_key = generate_api_key()
+        expiry = (datetime.now() + timedelta(days=int(payload.get('expiryDays', 30)))).isoformat()
+        
+        data['apis'][api_key] = {
+            'user_id': payload['telegramId'],
+            'username': payload['userName'],
+            'type': payload['apiType'],
+            'requests': 0,
+            'limit': int(payload['rateLimit']),
+            'status': 'active',
+            'created': datetime.now().isoformat(),
+            'expiry': expiry
+        }
+        
+        # Revoke the key being replaced so it doesn't stay usable while orphaned
+        previous_key = data['users'].get(payload['telegramId'], {}).get('api_key')
+        if previous_key in data['apis']:
+            data['apis'][previous_key]['status'] = 'revoked'
+            data['apis'][previous_key]['revoked_at'] = datetime.now().isoformat()
+        
+        data['users'][payload['telegramId']] = {
+            'name': payload['userName'],
+            'api_key': api_key,
+            'status': 'active',
+            'expiry': expiry,
+            'telegram_id': payload['telegramId']
+        }
+        
+        record_commission(data, payload['telegramId'], api_key)
+        save_data(data)
     
-    save_data(data)
     log_activity(payload['userName'], 'API Generated via Admin Panel')
     
     # Send admin notification
@@ -542,25 +1319,26 @@ def generate_api():
 
 📅 Time: {datetime.now().strftime('%d %b %Y, %H:%M:%S')}
 """
-    asyncio.run(send_admin_notification(admin_notif))
+    run_async(send_admin_notification(admin_notif))
     
     return jsonify({'success': True, 'api_key': api_key})
 
 @app.route('/api/delete/<api_key>', methods=['DELETE'])
 def delete_api(api_key):
     try:
-        data = load_data()
+        def remove(data):
+            api_info = data['apis'].pop(api_key, None)
+            if api_info is not None:
+                user_id = api_info.get('user_id')
+                if user_id in data['users'] and data['users'][user_id].get('api_key') == api_key:
+                    del data['users'][user_id]
+            return api_info
+        
+        api_info = update_data(remove)
         
-        if api_key in data['apis']:
-            api_info = data['apis'][api_key]
+        if api_info is not None:
             user_id = api_info.get('user_id')
             username = api_info.get('username')
-            
-            del data['apis'][api_key]
-            if user_id and user_id in data['users']:
-                del data['users'][user_id]
-            
-            save_data(data)
             log_activity('Admin', f'API Deleted: {api_key[:20]}...')
             
             # Send admin notification
@@ -573,7 +1351,7 @@ def delete_api(api_key):
 
 📅 Time: {datetime.now().strftime('%d %b %Y, %H:%M:%S')}
 """
-            asyncio.run(send_admin_notification(admin_notif))
+            run_async(send_admin_notification(admin_notif))
             
             return jsonify({'success': True, 'message': 'API deleted'})
         else:
@@ -584,12 +1362,16 @@ def delete_api(api_key):
 @app.route('/api/revoke/<api_key>', methods=['POST'])
 def revoke_api(api_key):
     try:
-        data = load_data()
+        def revoke(data):
+            api_info = data['apis'].get(api_key)
+            if api_info is not None:
+                api_info['status'] = 'revoked'
+                api_info['revoked_at'] = datetime.now().isoformat()
+            return api_info
         
-        if api_key in data['apis']:
-            api_info = data['apis'][api_key]
-            data['apis'][api_key]['status'] = 'revoked'
-            save_data(data)
+        api_info = update_data(revoke)
+        
+        if api_info is not None:
             log_activity('Admin', f'API Revoked: {api_key[:20]}...')
             
             # Send admin notification
@@ -602,7 +1384,7 @@ def revoke_api(api_key):
 
 📅 Time: {datetime.now().strftime('%d %b %Y, %H:%M:%S')}
 """
-            asyncio.run(send_admin_notification(admin_notif))
+            run_async(send_admin_notification(admin_notif))
             
             return jsonify({'success': True, 'message': 'API revoked'})
         else:
@@ -620,6 +1402,10 @@ def broadcast_message():
         if not message:
             return jsonify({'error': 'Message required'}), 400
         
+        bot = get_bot()
+        if bot is None:
+            return jsonify({'error': 'Bot not initialized'}), 500
+        
         data = load_data()
         users = data['users']
         
@@ -628,7 +1414,7 @@ def broadcast_message():
         
         for user_id in users.keys():
             try:
-                asyncio.run(bot_application.bot.send_message(chat_id=int(user_id), text=message, parse_mode='HTML'))
+                run_async(bot.bot.send_message(chat_id=int(user_id), text=message, parse_mode='HTML'))
                 sent_count += 1
             except Exception as e:
                 logger.error(f"Failed to send to {user_id}: {e}")
@@ -646,7 +1432,7 @@ def broadcast_message():
 
 📅 Time: {datetime.now().strftime('%d %b %Y, %H:%M:%S')}
 """
-        asyncio.run(send_admin_notification(admin_notif))
+        run_async(send_admin_notification(admin_notif))
         
         return jsonify({
             'success': True,
@@ -657,22 +1443,61 @@ def broadcast_message():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/backups', methods=['GET', 'POST'])
+def backups():
+    try:
+        if request.method == 'POST':
+            payload = request.get_json(silent=True) or {}
+            entry = take_snapshot(full=bool(payload.get('full')))
+            if entry is None:
+                return jsonify({'success': False, 'message': 'Nothing to back up'}), 404
+            log_activity('Admin', f"Snapshot taken: {entry['id']}")
+            return jsonify({'success': True, 'snapshot': entry})
+        return jsonify(load_manifest()['snapshots'][::-1])
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/compaction', methods=['GET', 'POST'])
+def compaction():
+    try:
+        if request.method == 'POST':
+            return jsonify({'success': True, 'stats': compact_keys()})
+        data = load_data()
+        stats = dict(data.get('compaction', {}))
+        stats['hot_keys'] = len(data['apis'])
+        stats['pending'] = len(find_compactable_keys(data))
+        return jsonify(stats)
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/restore', methods=['POST'])
+def restore():
+    try:
+        payload = request.get_json(silent=True) or {}
+        snapshot_id = payload.get('snapshot')
+        
+        if snapshot_id and snapshot_id not in [snap['id'] for snap in load_manifest()['snapshots']]:
+            return jsonify({'success': False, 'message': 'Not found'}), 404
+        
+        if restore_snapshot(snapshot_id) is None:
+            return jsonify({'success': False, 'message': 'No snapshots'}), 404
+        
+        log_activity('Admin', f"Restored snapshot {snapshot_id or 'latest'}")
+        return jsonify({'success': True, 'snapshot': snapshot_id or 'latest'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     try:
-        global bot_application
-        if bot_application is None:
-            bot_application = setup_bot()
-        
-        if bot_application is None:
+        bot = get_bot()
+        if bot is None:
             return jsonify({'error': 'Bot not initialized'}), 500
         
-        from telegram import Update
-        
         update_data = request.get_json(force=True)
-        update = Update.de_json(update_data, bot_application.bot)
+        update = Update.de_json(update_data, bot.bot)
         
-        asyncio.run(bot_application.process_update(update))
+        run_async(bot.process_update(update))
         
         return jsonify({'ok': True})
     except Exception as e:
@@ -682,11 +1507,8 @@ def webhook():
 @app.route('/setup_webhook', methods=['GET', 'POST'])
 def setup_webhook():
     try:
-        global bot_application
-        if bot_application is None:
-            bot_application = setup_bot()
-        
-        if bot_application is None:
+        bot = get_bot()
+        if bot is None:
             return jsonify({'error': 'Bot not configured'}), 400
         
         data = load_data()
@@ -696,7 +1518,7 @@ def setup_webhook():
             return jsonify({'error': 'Webhook URL not set'}), 400
         
         full_url = f"{webhook_url.rstrip('/')}/webhook"
-        asyncio.run(bot_application.bot.set_webhook(url=full_url))
+        run_async(bot.bot.set_webhook(url=full_url))
         
         logger.info(f"Webhook set: {full_url}")
         log_activity('System', 'Webhook Configured')
@@ -711,7 +1533,7 @@ def setup_webhook():
 
 🤖 Bot is now active!
 """
-        asyncio.run(send_admin_notification(admin_notif))
+        run_async(send_admin_notification(admin_notif))
         
         return jsonify({
             'success': True,
@@ -725,12 +1547,12 @@ def setup_webhook():
 @app.route('/bot_status', methods=['GET'])
 def bot_status():
     try:
-        global bot_application
-        if bot_application is None:
+        bot = bot_application
+        if bot is None:
             return jsonify({'initialized': False, 'message': 'Bot not initialized'})
         
-        bot_info = asyncio.run(bot_application.bot.get_me())
-        webhook_info = asyncio.run(bot_application.bot.get_webhook_info())
+        bot_info = bot.bot.bot
+        webhook_info = run_async(bot.bot.get_webhook_info())
         
         return jsonify({
             'initialized': True,
@@ -753,5 +1575,7 @@ def health():
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    bot_application = setup_bot()
+    start_bot()
+    start_backups()
+    start_compactor()
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
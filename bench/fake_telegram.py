@@ -0,0 +1,177 @@
+"""Local stub of the Telegram Bot API for benchmarking app.py.
+
+Serves ``/bot<token>/<method>`` for the methods the bot uses, with
+configurable latency and failure injection. Point the app at it with
+``TELEGRAM_API_URL=http://127.0.0.1:<port>``.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {
+    'id': 100000001,
+    'is_bot': True,
+    'first_name': 'Bench Bot',
+    'username': 'bench_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': False
+}
+
+
+class FakeTelegram:
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, jitter_ms=0, failure_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.calls = {}
+        self.failures = 0
+        self.webhook_url = ''
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = {}
+            self.failures = 0
+
+    def _next_message(self, chat_id, text):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': BOT_USER,
+            'text': text or ''
+        }
+
+    def handle(self, method, params):
+        """Return (ok, result) for a Bot API method call"""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        delay = self.latency_ms + (random.uniform(0, self.jitter_ms) if self.jitter_ms else 0)
+        if delay:
+            time.sleep(delay / 1000)
+
+        if self.failure_rate and random.random() < self.failure_rate:
+            with self._lock:
+                self.failures += 1
+            return False, 'Injected failure'
+
+        chat_id = params.get('chat_id', 1)
+        if method == 'getMe':
+            return True, BOT_USER
+        if method in ('sendMessage', 'editMessageText'):
+            return True, self._next_message(chat_id, params.get('text'))
+        if method == 'getChatMember':
+            return True, {
+                'status': 'member',
+                'user': {'id': int(params.get('user_id', 1)), 'is_bot': False, 'first_name': 'User'}
+            }
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url', '')
+            return True, True
+        if method == 'deleteWebhook':
+            self.webhook_url = ''
+            return True, True
+        if method == 'getWebhookInfo':
+            return True, {
+                'url': self.webhook_url,
+                'has_custom_certificate': False,
+                'pending_update_count': 0
+            }
+        if method in ('answerCallbackQuery', 'close', 'logOut'):
+            return True, True
+        return False, f'Method {method} not stubbed'
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                params = _parse_params(self.headers.get('Content-Type', ''), body)
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+
+                ok, result = fake.handle(method, params)
+                if ok:
+                    status, payload = 200, {'ok': True, 'result': result}
+                else:
+                    status, payload = 500, {'ok': False, 'error_code': 500, 'description': result}
+
+                raw = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _parse_params(content_type, body):
+    if not body:
+        return {}
+    if 'application/json' in content_type:
+        return json.loads(body)
+    if 'application/x-www-form-urlencoded' in content_type:
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+    if 'multipart/form-data' in content_type and 'boundary=' in content_type:
+        boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+        params = {}
+        for part in body.split(b'--' + boundary):
+            head, sep, value = part.partition(b'\r\n\r\n')
+            if not sep or b'name="' not in head:
+                continue
+            name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+            params[name] = value.rstrip(b'\r\n').decode(errors='replace')
+        return params
+    return {}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the fake Telegram Bot API')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(port=args.port, latency_ms=args.latency_ms,
+                        jitter_ms=args.jitter_ms, failure_rate=args.failure_rate)
+    print(f"Fake Telegram API listening on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,406 @@
+"""Load-test harness for app.py.
+
+Starts the Flask app in-process against the fake Telegram Bot API, replays
+synthetic /start and callback-query updates into /webhook at a fixed rate,
+drives the admin endpoints, and reports throughput, latency percentiles,
+data-file writes, memory and bot startup/swap time. Each run is appended to bench/results.jsonl
+and compared with the previous run of the same scenario.
+
+    python bench/run_bench.py --scenario all --rate 50 --duration 10
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_FILE = os.path.join(BENCH_DIR, 'results.jsonl')
+BOT_TOKEN = '123456:BENCHMARK-TOKEN'
+
+sys.path.insert(0, BENCH_DIR)
+from fake_telegram import FakeTelegram  # noqa: E402
+
+CALLBACKS = ['get_api', 'dashboard', 'become_reseller', 'wallet', 'help']
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def incr(self):
+        with self._lock:
+            self.value += 1
+
+
+def bench_env(fake_url, data_dir):
+    """Environment that keeps every file app.py writes inside the scratch directory"""
+    return {
+        'DATA_FILE': os.path.join(data_dir, 'data.json'),
+        'BACKUP_DIR': os.path.join(data_dir, 'backups'),
+        'ARCHIVE_FILE': os.path.join(data_dir, 'archive.jsonl.gz'),
+        'COMMISSIONS_FILE': os.path.join(data_dir, 'commissions.jsonl'),
+        'TELEGRAM_API_URL': fake_url,
+        'BOT_TOKEN': BOT_TOKEN
+    }
+
+
+def boot_app(fake_url, data_dir):
+    """Import app.py in-process against the fake API and time start_bot().
+
+    This skips gunicorn's preload/post_fork path; time_gunicorn_boot covers that.
+    """
+    os.environ.update(bench_env(fake_url, data_dir))
+    sys.path.insert(0, ROOT_DIR)
+
+    started = time.perf_counter()
+    import app as bot_app
+    import_ms = (time.perf_counter() - started) * 1000
+
+    writes = Counter()
+    save_data = bot_app.save_data
+
+    def counting_save_data(data):
+        writes.incr()
+        save_data(data)
+
+    bot_app.save_data = counting_save_data
+
+    started = time.perf_counter()
+    bot_app.start_bot()
+    start_ms = (time.perf_counter() - started) * 1000
+
+    return bot_app, writes, {'import_ms': round(import_ms, 2), 'bot_start_ms': round(start_ms, 2)}
+
+
+def free_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def time_gunicorn_boot(fake_url, data_dir, workers, timeout=60):
+    """Time a real gunicorn boot with gunicorn.conf.py until a worker reports its bot is up"""
+    if shutil.which('gunicorn') is None:
+        return None
+
+    port = free_port()
+    env = dict(os.environ, **bench_env(fake_url, os.path.join(data_dir, 'gunicorn')), WEB_CONCURRENCY=str(workers))
+    os.makedirs(os.path.join(data_dir, 'gunicorn'), exist_ok=True)
+
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        ['gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                return None
+            try:
+                health = requests.get(f'http://127.0.0.1:{port}/health', timeout=1).json()
+                if health.get('bot_initialized'):
+                    return round((time.perf_counter() - started) * 1000, 2)
+            except (requests.RequestException, ValueError):
+                pass
+            time.sleep(0.02)
+        return None
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def time_swap(bot_app):
+    """Time warming up a replacement bot and swapping it in"""
+    started = time.perf_counter()
+    bot_app.swap_bot(force=True)
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def serve(flask_app):
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+class Traffic:
+    """Synthetic Telegram updates and admin calls"""
+
+    def __init__(self, users, referral_codes):
+        self.users = users
+        self.referral_codes = referral_codes
+        self._update_id = 0
+        self._lock = threading.Lock()
+
+    def _next_id(self):
+        with self._lock:
+            self._update_id += 1
+            return self._update_id
+
+    def _user(self):
+        uid = random.randint(1, self.users) + 5000000
+        return {'id': uid, 'is_bot': False, 'first_name': f'User{uid}', 'username': f'user{uid}'}
+
+    def start_update(self):
+        user = self._user()
+        text = '/start'
+        if self.referral_codes and random.random() < 0.3:
+            text = f"/start {random.choice(self.referral_codes)}"
+        return {
+            'update_id': self._next_id(),
+            'message': {
+                'message_id': self._next_id(),
+                'date': int(time.time()),
+                'chat': {'id': user['id'], 'type': 'private'},
+                'from': user,
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+            }
+        }
+
+    def callback_update(self):
+        user = self._user()
+        return {
+            'update_id': self._next_id(),
+            'callback_query': {
+                'id': str(self._next_id()),
+                'from': user,
+                'chat_instance': str(user['id']),
+                'data': random.choice(CALLBACKS),
+                'message': {
+                    'message_id': self._next_id(),
+                    'date': int(time.time()),
+                    'chat': {'id': user['id'], 'type': 'private'},
+                    'text': 'menu'
+                }
+            }
+        }
+
+    def request(self, scenario):
+        """Return (method, path, json) for one request of the scenario"""
+        if scenario == 'start':
+            return 'POST', '/webhook', self.start_update()
+        if scenario == 'callback':
+            return 'POST', '/webhook', self.callback_update()
+        if scenario == 'admin':
+            roll = random.random()
+            if roll < 0.1:
+                uid = str(random.randint(1, self.users) + 9000000)
+                return 'POST', '/api/generate', {
+                    'telegramId': uid,
+                    'userName': f'Admin{uid}',
+                    'apiType': 'perplexity',
+                    'rateLimit': 1000,
+                    'expiryDays': 30
+                }
+            path = random.choice(['/api/stats', '/api/users', '/api/apis', '/api/leaderboard', '/health'])
+            return 'GET', path, None
+        return self.request(random.choice(['start', 'callback', 'callback', 'admin']))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_scenario(base_url, traffic, scenario, rate, duration, concurrency):
+    """Open-loop load: requests are scheduled at a fixed rate and latency is
+    measured from the scheduled send time, so a stalled server is not hidden
+    by the client backing off."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+
+    latencies = []
+    errors = Counter()
+    lock = threading.Lock()
+    total = int(rate * duration)
+
+    def fire(scheduled, method, path, payload):
+        try:
+            response = session.request(method, base_url + path, json=payload, timeout=30)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = (time.perf_counter() - scheduled) * 1000
+        with lock:
+            latencies.append(elapsed)
+        if not ok:
+            errors.incr()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(total):
+            scheduled = started + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(fire, scheduled, *traffic.request(scenario))
+    wall = time.perf_counter() - started
+
+    return {
+        'requests': total,
+        'errors': errors.value,
+        'error_rate': round(errors.value / total, 4) if total else 0,
+        'wall_s': round(wall, 3),
+        'throughput_rps': round(total / wall, 2) if wall else 0,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(max(latencies), 2) if latencies else 0
+    }
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def error_rate(metrics):
+    return metrics.get('errors', 0) / metrics['requests'] if metrics.get('requests') else 0
+
+
+def previous_result(scenario, max_error_rate):
+    """Last saved run of the scenario that is usable as a baseline"""
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    last = None
+    with open(RESULTS_FILE) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('scenario') == scenario and error_rate(entry.get('metrics', {})) <= max_error_rate:
+                last = entry
+    return last
+
+
+def report(result, previous):
+    metrics = result['metrics']
+    print(f"\n== {result['scenario']} @ {result['params']['rate']} req/s ({result['revision']}) ==")
+    for key in ('requests', 'errors', 'error_rate', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms',
+                'data_writes', 'writes_per_request', 'data_file_kb', 'rss_kb', 'telegram_calls',
+                'import_ms', 'bot_start_ms', 'bot_swap_ms', 'gunicorn_boot_ms'):
+        value = metrics.get(key)
+        line = f"  {key:<20} {value}"
+        old = (previous or {}).get('metrics', {}).get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"  ({(value - old) / old * 100:+.1f}% vs {previous['revision']})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark app.py against a fake Telegram API')
+    parser.add_argument('--scenario', choices=['start', 'callback', 'admin', 'mixed', 'all'], default='all')
+    parser.add_argument('--rate', type=float, default=50, help='requests per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=500, help='distinct synthetic users')
+    parser.add_argument('--latency-ms', type=float, default=20, help='fake Telegram API latency')
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of Telegram calls that fail')
+    parser.add_argument('--max-error-rate', type=float, default=0.05,
+                        help='fail the run and skip saving when more requests than this fraction error')
+    parser.add_argument('--gunicorn-workers', type=int, default=1,
+                        help='workers for the gunicorn boot timing (0 to skip it)')
+    parser.add_argument('--no-save', action='store_true', help='do not append to results.jsonl')
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                        failure_rate=args.failure_rate).start()
+    data_dir = tempfile.mkdtemp(prefix='bench-')
+    bot_app = server = None
+
+    referral_codes = []
+    failed = []
+    scenarios = ['start', 'callback', 'admin', 'mixed'] if args.scenario == 'all' else [args.scenario]
+
+    try:
+        startup = {}
+        if args.gunicorn_workers:
+            startup['gunicorn_boot_ms'] = time_gunicorn_boot(fake.url, data_dir, args.gunicorn_workers)
+        bot_app, writes, in_process = boot_app(fake.url, data_dir)
+        startup.update(in_process)
+        startup['bot_swap_ms'] = time_swap(bot_app)
+        server, base_url = serve(bot_app.app)
+
+        for scenario in scenarios:
+            traffic = Traffic(args.users, referral_codes)
+            fake.reset_stats()
+            writes.value = 0
+
+            metrics = run_scenario(base_url, traffic, scenario, args.rate, args.duration, args.concurrency)
+            metrics['data_writes'] = writes.value
+            metrics['writes_per_request'] = round(writes.value / metrics['requests'], 3) if metrics['requests'] else 0
+            metrics['data_file_kb'] = round(os.path.getsize(bot_app.DATA_FILE) / 1024, 1) if os.path.exists(bot_app.DATA_FILE) else 0
+            metrics['rss_kb'] = rss_kb()
+            metrics['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            metrics['telegram_calls'] = sum(fake.calls.values())
+            metrics['telegram_failures'] = fake.failures
+            metrics.update(startup)
+
+            referral_codes[:] = list(bot_app.load_data().get('referral_index', {}))
+
+            result = {
+                'time': datetime.now().isoformat(),
+                'revision': git_revision(),
+                'scenario': scenario,
+                'params': {k: v for k, v in vars(args).items() if k not in ('scenario', 'no_save')},
+                'metrics': metrics
+            }
+            report(result, previous_result(scenario, args.max_error_rate))
+
+            # Latencies of a mostly failing run time the error path, not the app
+            if metrics['error_rate'] > args.max_error_rate:
+                print(f"  !! error rate {metrics['error_rate']:.1%} exceeds --max-error-rate "
+                      f"{args.max_error_rate:.1%}; result not saved", file=sys.stderr)
+                failed.append(scenario)
+            elif not args.no_save:
+                with open(RESULTS_FILE, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+    finally:
+        if server is not None:
+            server.shutdown()
+        if bot_app is not None:
+            bot_app.stop_bot()
+        fake.stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    if failed:
+        sys.exit(f"Benchmark failed: too many errors in {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
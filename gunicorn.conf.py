@@ -0,0 +1,15 @@
+# Load app.py (and python-telegram-bot) once in the master, then give each
+# forked worker its own initialized bot before it accepts requests.
+preload_app = True
+
+
+def post_fork(server, worker):
+    import app
+    app.start_bot()
+    app.start_backups()
+    app.start_compactor()
+
+
+def worker_exit(server, worker):
+    import app
+    app.stop_bot()
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot_app  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """Point every file app.py writes at a scratch directory"""
+    monkeypatch.setattr(bot_app, 'DATA_FILE', str(tmp_path / 'data.json'))
+    monkeypatch.setattr(bot_app, 'BACKUP_DIR', str(tmp_path / 'backups'))
+    monkeypatch.setattr(bot_app, 'ARCHIVE_FILE', str(tmp_path / 'archive.jsonl.gz'))
+    monkeypatch.setattr(bot_app, 'COMMISSIONS_FILE', str(tmp_path / 'commissions.jsonl'))
+    monkeypatch.setattr(bot_app, '_snapshot_base', None)
+    bot_app.save_data(bot_app.load_data())
+    return bot_app
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+
+class FakeApplication:
+    def __init__(self, token, delay=0):
+        self.token = token
+        self.delay = delay
+        self.shut_down = False
+
+    async def initialize(self):
+        time.sleep(self.delay)
+
+    async def shutdown(self):
+        self.shut_down = True
+
+
+@pytest.fixture
+def bot(store, monkeypatch):
+    built = []
+
+    def setup_bot(bot_token=None):
+        if not bot_token:
+            return None
+        application = FakeApplication(bot_token, delay=0.2 if bot_token == 'slow' else 0)
+        built.append(application)
+        return application
+
+    monkeypatch.delenv('BOT_TOKEN', raising=False)
+    monkeypatch.setattr(store, 'setup_bot', setup_bot)
+    monkeypatch.setattr(store, 'BOT_RETIRE_GRACE', 0)
+    store.update_data(lambda data: data['settings'].update({'bot_token': 'token-a'}))
+    store.start_bot()
+    yield built
+    store.stop_bot()
+
+
+def _set_token(app, token):
+    app.update_data(lambda data: data['settings'].update({'bot_token': token}))
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_worker_follows_token_changed_elsewhere(store, bot):
+    assert store.get_bot().token == 'token-a'
+
+    # Another worker saved new settings; this worker only sees data.json change
+    _set_token(store, 'token-b')
+    store.get_bot()
+
+    assert _wait_for(lambda: store.bot_application.token == 'token-b')
+    assert _wait_for(lambda: bot[0].shut_down)
+
+
+def test_unchanged_token_does_not_rebuild(store, bot):
+    store.get_bot()
+    store.swap_bot()
+    assert len(bot) == 1
+
+
+def test_overlapping_swaps_install_newest_token(store, bot):
+    _set_token(store, 'slow')
+    first = threading.Thread(target=store.swap_bot)
+    first.start()
+    time.sleep(0.05)
+    _set_token(store, 'token-c')
+    second = threading.Thread(target=store.swap_bot)
+    second.start()
+    first.join()
+    second.join()
+
+    assert store.bot_application.token == 'token-c'
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+
+def _add_reseller(app, user_id='100', code='CODE1234'):
+    def add(data):
+        data['resellers'][user_id] = {
+            'id': f'RSL{user_id}',
+            'name': 'Reseller',
+            'commission': 20,
+            'sales': 0,
+            'earnings': 0,
+            'pending': 0,
+            'withdrawn': 0,
+            'status': 'active',
+            'referral_code': code
+        }
+        data['referral_index'][code] = user_id
+    app.update_data(add)
+
+
+def test_only_new_users_are_attributed(store):
+    _add_reseller(store)
+    store.update_data(lambda data: data['users'].update({'2': {'name': 'Old', 'api_key': None}}))
+
+    data = store.load_data()
+    assert store.attribute_referral(data, 1, 'code1234') == '100'
+    assert store.attribute_referral(data, 2, 'CODE1234') is None
+    assert store.attribute_referral(data, 100, 'CODE1234') is None
+
+
+def test_only_first_sale_earns_commission(store):
+    _add_reseller(store)
+
+    def sell(data):
+        store.attribute_referral(data, 1, 'CODE1234')
+        return store.record_commission(data, 1, 'key-1'), store.record_commission(data, 1, 'key-2')
+
+    first, renewal = store.update_data(sell)
+
+    reseller = store.load_data()['resellers']['100']
+    assert first['amount'] == 99
+    assert renewal is None
+    assert (reseller['sales'], reseller['earnings'], reseller['pending']) == (1, 99, 99)
+    assert [entry['api_key'] for entry in store.read_ledger()] == ['key-1']
+
+
+def test_withdrawal_moves_pending_to_withdrawn(store):
+    _add_reseller(store)
+    store.update_data(lambda data: (store.attribute_referral(data, 1, 'CODE1234'),
+                                    store.record_commission(data, 1, 'key-1')))
+
+    store.update_data(lambda data: store.record_withdrawal(data, '100', 50))
+    with pytest.raises(ValueError):
+        store.update_data(lambda data: store.record_withdrawal(data, '100', 50))
+
+    reseller = store.load_data()['resellers']['100']
+    assert (reseller['pending'], reseller['withdrawn'], reseller['earnings']) == (49, 50, 99)
+    assert [entry['type'] for entry in store.read_ledger()] == ['credit', 'debit']
+
+
+def test_credits_survive_concurrent_activity_logging(store):
+    _add_reseller(store)
+
+    def sell(user_id):
+        def credit(data):
+            store.attribute_referral(data, user_id, 'CODE1234')
+            store.record_commission(data, user_id, f'key-{user_id}')
+        store.update_data(credit)
+
+    threads = [threading.Thread(target=sell, args=(uid,)) for uid in range(1, 21)]
+    threads += [threading.Thread(target=store.log_activity, args=('User', 'Bot Started')) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reseller = store.load_data()['resellers']['100']
+    assert reseller['sales'] == 20
+    assert reseller['earnings'] == 20 * 99
+    assert len(store.read_ledger()) == 20
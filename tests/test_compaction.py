@@ -0,0 +1,93 @@
+import gzip
+import json
+import threading
+from datetime import datetime, timedelta
+
+
+def _api(user_id, created, expiry, status='active'):
+    return {
+        'user_id': user_id,
+        'username': f'User{user_id}',
+        'type': 'perplexity',
+        'requests': 0,
+        'limit': 1000,
+        'status': status,
+        'created': created.isoformat(),
+        'expiry': expiry.isoformat()
+    }
+
+
+def _seed(app, apis, users):
+    def seed(data):
+        data['apis'].update(apis)
+        data['users'].update(users)
+    app.update_data(seed)
+
+
+def _archive_rows(app):
+    with gzip.open(app.ARCHIVE_FILE, 'rt') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_writer_after_compaction_does_not_resurrect_keys(store):
+    old = datetime.now() - timedelta(days=60)
+    _seed(store, {'expired': _api('1', old, old)}, {'1': {'name': 'User1', 'api_key': 'expired'}})
+
+    store.compact_keys()
+    store.log_activity('User1', 'Bot Started')
+    store.compact_keys()
+
+    data = store.load_data()
+    assert 'expired' not in data['apis']
+    assert data['compaction']['total_archived'] == 1
+    assert data['activities'][0]['action'] == 'Bot Started'
+    assert [row['key'] for row in _archive_rows(store)] == ['expired']
+
+
+def test_concurrent_writers_and_compaction_lose_no_updates(store):
+    old = datetime.now() - timedelta(days=60)
+    _seed(store, {f'k{i}': _api(str(i), old, old) for i in range(20)}, {})
+
+    def bump(data):
+        data['settings']['counter'] = data['settings'].get('counter', 0) + 1
+
+    def writer():
+        for _ in range(25):
+            store.update_data(bump)
+
+    threads = [threading.Thread(target=writer) for _ in range(4)]
+    threads.append(threading.Thread(target=store.compact_keys))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    data = store.load_data()
+    assert data['settings']['counter'] == 100
+    assert data['apis'] == {}
+    assert len(_archive_rows(store)) == 20
+
+
+def test_archived_key_clears_user_pointer(store):
+    old = datetime.now() - timedelta(days=60)
+    _seed(store, {'expired': _api('1', old, old)}, {'1': {'name': 'User1', 'api_key': 'expired', 'status': 'active'}})
+
+    store.compact_keys()
+
+    user = store.load_data()['users']['1']
+    assert user['api_key'] is None
+    assert user['status'] == 'expired'
+
+
+def test_unreferenced_keys_get_grace_period(store):
+    now = datetime.now()
+    old = now - timedelta(days=60)
+    _seed(store, {
+        'fresh-orphan': _api('1', now, now + timedelta(days=30)),
+        'old-orphan': _api('1', old, now + timedelta(days=30)),
+        'current': _api('1', now, now + timedelta(days=30))
+    }, {'1': {'name': 'User1', 'api_key': 'current'}})
+
+    reasons = store.find_compactable_keys(store.load_data())
+
+    assert reasons == {'old-orphan': 'unreferenced'}
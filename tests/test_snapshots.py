@@ -0,0 +1,51 @@
+import copy
+import os
+import stat
+
+
+def test_diff_round_trips_prepend_with_truncation(store):
+    old = {'activities': [{'i': n} for n in range(100)]}
+    new = {'activities': [{'i': 'a'}, {'i': 'b'}] + old['activities'][:98]}
+
+    delta = store.diff_state(old, new)
+
+    assert delta['activities'] == {'prepend': [{'i': 'a'}, {'i': 'b'}], 'length': 100}
+    assert store.apply_delta(copy.deepcopy(old), delta) == new
+
+
+def test_diff_round_trips_dict_set_del_and_section_drop(store):
+    old = {'users': {'1': {'n': 1}, '2': {'n': 2}}, 'gone': {'x': 1}, 'log': [1, 2]}
+    new = {'users': {'1': {'n': 10}, '3': {'n': 3}}, 'log': [1, 2, 3], 'added': 'v'}
+
+    delta = store.diff_state(old, new)
+
+    assert delta['users'] == {'set': {'1': {'n': 10}, '3': {'n': 3}}, 'del': ['2']}
+    assert delta['gone'] == {'drop': True}
+    assert delta['log'] == {'append': [3]}
+    assert store.apply_delta(copy.deepcopy(old), delta) == new
+
+
+def test_restore_from_cold_cache(store, monkeypatch):
+    states = []
+    for n in range(4):
+        store.log_activity('User', f'action {n}')
+        store.update_data(lambda data, n=n: data['users'].update({str(n): {'name': f'User{n}'}}))
+        entry = store.take_snapshot(full=(n == 0))
+        states.append((entry['id'], store.read_snapshot_state()))
+
+    assert [snap['type'] for snap in store.load_manifest()['snapshots']] == ['full', 'delta', 'delta', 'delta']
+
+    # A fresh worker has no in-memory base and must rebuild from the chain
+    monkeypatch.setattr(store, '_snapshot_base', None)
+    for snapshot_id, state in states:
+        assert store.restore_state(snapshot_id) == state
+
+    store.restore_snapshot(states[1][0])
+    assert store.read_snapshot_state() == states[1][1]
+    assert store.load_manifest()['snapshots'][-1]['type'] == 'full'
+
+
+def test_atomic_write_keeps_file_mode(store):
+    os.chmod(store.DATA_FILE, 0o640)
+    store.save_data(store.load_data())
+    assert stat.S_IMODE(os.stat(store.DATA_FILE).st_mode) == 0o640